@@ -4,17 +4,69 @@
 more charms according to a YAML configuration.
 """
 
+import argparse
+import concurrent.futures
 import fnmatch
+import functools
 import os
 import os.path
+import re
 import shutil
 import subprocess
 import sys
+import threading
 import yaml
 
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
 import lxc
 
 
+@functools.lru_cache(maxsize=None)
+def _load_yaml(path, mtime):
+    """Load a YAML file, memoized by (path, mtime) so that unchanged
+    files are parsed only once per run."""
+
+    with open(path) as f:
+        return yaml.load(f, Loader=_SafeLoader)
+
+
+def filter_names(names, patterns):
+    """Filter names by one or more glob-style patterns.
+
+    The patterns are translated and compiled once into a single
+    alternation regex rather than calling `fnmatch.fnmatch` per name."""
+
+    if not patterns:
+        return list(names)
+
+    if isinstance(patterns, str):
+        patterns = [patterns]
+
+    rx = re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns))
+    return [name for name in names if rx.match(name)]
+
+
+_print_lock = threading.Lock()
+
+
+def log(*args, **kwargs):
+    """Print with a lock so that concurrent builds do not interleave
+    output mid-line."""
+
+    with _print_lock:
+        print(*args, **kwargs)
+
+
+def load_yaml(path):
+    """Load a YAML file via the mtime-keyed cache."""
+
+    return _load_yaml(path, os.stat(path).st_mtime_ns)
+
+
 class Builder:
     """Charms builder.
 
@@ -22,38 +74,34 @@ class Builder:
     provisioning, the `charmcraft.yaml` must specify an lxd image to
     use."""
 
-    def __init__(self, configpath, workdir=None, charmsdir=None, series=None):
+    def __init__(self, configpath, workdir=None, charmsdir=None, series=None, offline=False):
         self.configpath = configpath
         self.series = series
+        self.offline = offline
 
-        self.config = yaml.safe_load(open(configpath))
+        self.config = load_yaml(configpath)
 
         self.charmsdir = os.path.abspath(charmsdir if charmsdir else self.config["charmsdir"])
         self.workdir = os.path.abspath(workdir if workdir else self.config["workdir"])
         self.reposdir = f"{self.workdir}/repos"
+        self._prefetched = set()
+        self._lxcis = {}
+        self._lxcis_lock = threading.Lock()
+
+        # create once up front rather than checking per build
+        os.makedirs(self.charmsdir, exist_ok=True)
+        os.makedirs(self.reposdir, exist_ok=True)
 
     def build(self, name):
-        repo = self.config["charms"][name]["repo"]
-        branch = self.config["charms"][name].get("branch") or None
+        charmsdir = self.charmsdir
         charm_dir = self.get_charm_dir(name)
 
-        for path in [self.charmsdir, self.reposdir]:
-            if not os.path.exists(path):
-                os.makedirs(path)
+        log(f"building charm ({name}) series ({self.series}) ...")
 
-        print(f"building charm ({name}) series ({self.series}) ...")
-
-        # clone/update repo
-        print(f"looking for charm directory ({charm_dir})...")
-        if not os.path.exists(charm_dir):
-            print("cloning repo ...")
-            args = ["git", "clone", repo]
-            if branch:
-                args.extend(["-b", branch])
-            subprocess.run(args, cwd=self.reposdir)
-        else:
-            print("updating from repo ...")
-            subprocess.run(["git", "pull"], cwd=charm_dir)
+        # clone/update repo (unless already done by prefetch)
+        log(f"looking for charm directory ({charm_dir})...")
+        if name not in self._prefetched:
+            self.fetch(name)
 
         # get base configuration
         based = self.get_series_base(self.series)
@@ -61,100 +109,167 @@ class Builder:
         # get charmcraft.yaml base index
         bases_index = self.get_charmcraft_bases_index(charm_dir, self.series)
         if self.series != None and bases_index == None:
-            print(f"no base index for series ({self.series})")
+            log(f"no base index for series ({self.series})")
             return
 
-        try:
-            # provision (if necessary)
-            image = based.get("image")
-            if not image:
-                manual = False
-                lxci = None
-                print(f"automatic provisioning ...")
+        # provision (if necessary); containers are cached per image and
+        # stopped by close()
+        image = based.get("image")
+        if not image:
+            manual = False
+            lxci = None
+            log(f"automatic provisioning ...")
+        else:
+            manual = True
+            log(f"manual provisioning ...")
+            lxci = self.provision_or_get(based, charm_dir)
+            if lxci == None:
+                raise Exception(f"failed to provision for image ({image})")
+
+        # build
+        maxtry = manual and 1 or 2
+        for i in range(1, maxtry + 1):
+            log(f"building ({i}/{maxtry}) ...")
+            cmdargs = ["charmcraft", "-v", "pack"]
+            if manual:
+                cmdargs.append("--destructive-mode")
+                cp = lxci.exec(
+                    "--user",
+                    str(os.getuid()),
+                    "--cwd",
+                    charm_dir,
+                    "--",
+                    *cmdargs,
+                )
             else:
-                manual = True
-                print(f"manual provisioning ...")
-                print("starting container ...")
-                lxci = lxc.provision(based, charm_dir)
-                if lxci == None:
-                    raise Exception(f"failed to provision for image ({image})")
-
-            # build
-            maxtry = manual and 1 or 2
-            for i in range(1, maxtry + 1):
-                print(f"building ({i}/{maxtry}) ...")
-                cmdargs = ["charmcraft", "-v", "pack"]
+                if bases_index != None:
+                    cmdargs.extend(["--bases-index", str(bases_index)])
+                cp = subprocess.run(cmdargs, cwd=charm_dir, close_fds=False)
+
+            # copy results
+            if cp.returncode == 0:
+                prefix = charm_dir + "/"
+
                 if manual:
-                    cmdargs.append("--destructive-mode")
-                    cp = lxci.exec(
-                        "--user",
-                        str(os.getuid()),
-                        "--cwd",
-                        charm_dir,
-                        "--",
-                        *cmdargs,
-                    )
+                    filenames = lxci.list_charms(charm_dir)
+                    if filenames:
+                        log(f"""copying ({", ".join(filenames)}) ...""")
+                        lxci.file_pull_many(
+                            [prefix + filename for filename in filenames],
+                            charmsdir + "/",
+                        )
                 else:
-                    if bases_index != None:
-                        cmdargs.extend(["--bases-index", str(bases_index)])
-                    cp = subprocess.run(cmdargs, cwd=charm_dir)
-
-                # copy results
-                if cp.returncode == 0:
-                    if manual:
-                        filenames = lxci.listdir(charm_dir)
-                    else:
-                        filenames = os.listdir(charm_dir)
+                    filenames = [fn for fn in os.listdir(charm_dir) if fn.endswith(".charm")]
 
                     for filename in filenames:
-                        if filename.endswith(".charm"):
-                            charmpath = f"{charm_dir}/{filename}"
-                            print(f"copying ({filename}) ...")
-                            if manual:
-                                lxci.file_pull(charmpath, self.charmsdir)
-                            else:
-                                shutil.copy(charmpath, self.charmsdir)
+                        log(f"copying ({filename}) ...")
+                        # copyfile (not copy) skips the mode
+                        # stat/chmod and takes the kernel-side
+                        # zero-copy path for same-fs copies
+                        shutil.copyfile(prefix + filename, f"{charmsdir}/{filename}")
+            else:
+                log(f"error: charm ({name}) failed to build", file=sys.stderr)
+
+    def close(self):
+        """Stop all containers provisioned for builds."""
+
+        for lxci in self._lxcis.values():
+            log("stopping container ...")
+            lxci.stop(force=True)
+        self._lxcis.clear()
+
+    def provision_or_get(self, based, charm_dir):
+        """Get the container for a base image, provisioning on first
+        use. Reusing the container across builds that share an image
+        amortizes the multi-second boot cost."""
+
+        image = based.get("image")
+        with self._lxcis_lock:
+            lxci = self._lxcis.get(image)
+            if lxci == None:
+                log("starting container ...")
+                lxci = lxc.provision(based, charm_dir)
+                if lxci != None:
+                    self._lxcis[image] = lxci
+        return lxci
+
+    def fetch(self, name):
+        """Clone or update the repo for a charm."""
+
+        charm = self.config["charms"][name]
+        repo = charm["repo"]
+        branch = charm.get("branch") or None
+        charm_dir = self.get_charm_dir(name)
+
+        if not os.path.exists(charm_dir):
+            log(f"cloning repo for charm ({name}) ...")
+            args = ["git", "clone", "--depth=1", "--single-branch", repo]
+            if branch:
+                args.extend(["-b", branch])
+            subprocess.run(args, cwd=self.reposdir, close_fds=False)
+        elif self.offline:
+            log(f"skipping update for charm ({name}) (offline) ...")
+        else:
+            log(f"updating from repo for charm ({name}) ...")
+            # fetch + reset is cheaper than pull: no merge logic and no
+            # implicit fetch of all refs
+            args = ["git", "fetch", "--depth=1", "origin"]
+            if branch:
+                args.append(branch)
+            subprocess.run(args, cwd=charm_dir, close_fds=False)
+            subprocess.run(
+                ["git", "reset", "--hard", "FETCH_HEAD"], cwd=charm_dir, close_fds=False
+            )
+
+    def prefetch(self, names):
+        """Clone/update the repos for the named charms, in parallel,
+        ahead of the builds."""
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(self.fetch, names))
+        self._prefetched.update(names)
+
+    def _built_charm_names_set(self, patterns=None):
+        """Get names of built charms as an unsorted set, built directly
+        from the directory scan."""
+
+        names = set()
+        with os.scandir(self.charmsdir) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                filename = entry.name
+                if "_" in filename:
+                    names.add(filename[: filename.index("_")])
                 else:
-                    print(f"error: charm ({name}) failed to build", file=sys.stderr)
-        finally:
-            if manual:
-                print("stopping container ...")
-                lxci.stop(force=True)
+                    names.add(filename)
 
-    def get_built_charm_names(self, pattern=None):
-        for _, _, filenames in os.walk(self.charmsdir):
-            pass
+        if patterns:
+            names = set(filter_names(names, patterns))
+        return names
 
-        names = []
-        for filename in filenames:
-            if "_" in filename:
-                names.append(filename[: filename.index("_")])
-            else:
-                names.append(filename)
+    def _charm_names_set(self, patterns=None):
+        """Get names of all charms as an unsorted set."""
 
-        if pattern:
-            names = [name for name in names if fnmatch.fnmatch(name, pattern)]
+        return set(filter_names(self.config["charms"].keys(), patterns))
 
-        return sorted(names)
+    def get_built_charm_names(self, patterns=None):
+        return sorted(self._built_charm_names_set(patterns))
 
     def get_charm_dir(self, name):
         """Get charm directory (contains `charmcraft.yaml`)."""
 
         return f"{self.reposdir}/{name}"
 
-    def get_charm_names(self, pattern=None):
+    def get_charm_names(self, patterns=None):
         """Get names of all charms."""
 
-        names = self.config["charms"].keys()
-        if pattern:
-            names = [name for name in names if fnmatch.fnmatch(name, pattern)]
-
-        return sorted(names)
+        return sorted(self._charm_names_set(patterns))
 
     def get_charmcraft_bases_index(self, charm_dir, series):
         """Get bases index for series from `charmcraft.yaml`."""
 
-        d = yaml.safe_load(open(f"{charm_dir}/charmcraft.yaml"))
+        d = load_yaml(f"{charm_dir}/charmcraft.yaml")
 
         for i, based in enumerate(d.get("bases")):
             _series = f"""{based.get("name")}-{based.get("channel")}"""
@@ -184,7 +299,7 @@ def print_usage():
 
     print(
         f"""\
-usage: {progname} build [-c <config>] [-w workdir] [-C <charmsdir>] [-s <name>] [<name|pattern> [...]]
+usage: {progname} build [-c <config>] [-j <njobs>] [-w workdir] [-C <charmsdir>] [-s <name>] [--offline] [<name|pattern> [...]]
        {progname} list [-c <config>] [-s <name>] [<pattern> [...]]
        {progname} list-built [-c <config>] [-s <name>] [<pattern> [...]]
        {progname} list-missing [-c <config>] [-s <name>] [<pattern> [...]]
@@ -204,76 +319,80 @@ Options:
 -c <path>       Configuration file path. Default is
                 "charms-builder.yaml".
 -C <path>       Charms directory path. Default is "charms".
+-j <njobs>      Number of charms to build concurrently. Default is 1.
 -s <name>       Series to build for.
--w <path>       Working directory. Default is current directory."""
+-w <path>       Working directory. Default is current directory.
+--offline       Do not update already cloned repos."""
     )
 
 
 if __name__ == "__main__":
-    try:
-        charmsdir = "charms"
-        cmd = None
-        config = None
-        configpath = "charms-builder.yaml"
-        names = []
-        series = None
-        workdir = "."
-
-        args = sys.argv[1:]
-        cmd = args.pop(0)
-
-        while args:
-            arg = args.pop(0)
-            if arg in ["-h", "--help"]:
-                print_usage()
-                sys.exit(0)
-            elif arg == "-c":
-                configpath = args.pop(0)
-            elif arg == "-C":
-                charmsdir = args.pop(0)
-            elif arg == "-s":
-                series = args.pop(0)
-            elif arg == "-w":
-                workdir = args.pop(0)
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]),
+        add_help=False,
+    )
+    parser.add_argument("-h", "--help", action="store_true", dest="show_help")
+    parser.add_argument("-c", dest="configpath", default="charms-builder.yaml")
+    parser.add_argument("-C", dest="charmsdir", default="charms")
+    parser.add_argument("-j", dest="njobs", type=int, default=1)
+    parser.add_argument("-s", dest="series")
+    parser.add_argument("-w", dest="workdir", default=".")
+    parser.add_argument("--offline", action="store_true", dest="offline")
+    parser.add_argument("cmd", nargs="?")
+    parser.add_argument("names", nargs="*")
+
+    # intermixed: options may appear between the command and the
+    # name/pattern positionals, as the usage text documents
+    xargs = parser.parse_intermixed_args()
+
+    if xargs.show_help or not xargs.cmd:
+        print_usage()
+        sys.exit(0)
+
+    charmsdir = xargs.charmsdir
+    cmd = xargs.cmd
+    configpath = xargs.configpath
+    names = xargs.names
+    njobs = xargs.njobs
+    offline = xargs.offline
+    series = xargs.series
+    workdir = xargs.workdir
+
+    b = Builder(configpath, workdir, charmsdir, series, offline)
+
+    if cmd == "build":
+        _names = []
+        for name in names:
+            _names.extend(b.get_charm_names(name))
+
+        b.prefetch(_names)
+
+        try:
+            if njobs > 1:
+                # builds are independent `charmcraft pack` runs; threads
+                # suffice since the work is in subprocesses
+                with concurrent.futures.ThreadPoolExecutor(max_workers=njobs) as pool:
+                    list(pool.map(b.build, _names))
             else:
-                names.append(arg)
-
-        if not configpath:
-            print("error: missing config path", file=sys.stderr)
-            sys.exit(1)
-    except SystemExit:
-        raise
-    except:
-        print("error: bad/missing argument", file=sys.stderr)
-        sys.exit(1)
-
-    try:
-        b = Builder(configpath, workdir, charmsdir, series)
-
-        if cmd == "build":
-            _names = []
-            for name in names:
-                _names.extend(b.get_charm_names(name))
-
-            for _name in _names:
-                b.build(_name)
-
-        if cmd == "list":
-            print("\n".join(b.get_charm_names(names)))
-            sys.exit(0)
-
-        if cmd == "list-built":
-            print("\n".join(b.get_built_charm_names(names)))
-            sys.exit(0)
-
-        if cmd == "list-missing":
-            all_names = set(b.get_charm_names(names))
-            built_names = b.get_built_charm_names(names)
-            print("\n".join(sorted(all_names.difference(built_names))))
-            sys.exit(0)
-
-        if cmd == "list-series":
-            serieses = b.get_serieses()
-            print("\n".join(sorted(serieses)))
-    except:
-        raise
+                for _name in _names:
+                    b.build(_name)
+        finally:
+            b.close()
+
+    if cmd == "list":
+        print("\n".join(b.get_charm_names(names)))
+        sys.exit(0)
+
+    if cmd == "list-built":
+        print("\n".join(b.get_built_charm_names(names)))
+        sys.exit(0)
+
+    if cmd == "list-missing":
+        # sort only the final difference, not both inputs
+        missing = b._charm_names_set(names).difference(b._built_charm_names_set(names))
+        print("\n".join(sorted(missing)))
+        sys.exit(0)
+
+    if cmd == "list-series":
+        serieses = b.get_serieses()
+        print("\n".join(sorted(serieses)))
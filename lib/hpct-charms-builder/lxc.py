@@ -3,12 +3,29 @@
 #
 
 import grp
+import itertools
 import os
 import pwd
+import shlex
+import shutil
 import subprocess
-import time
 import traceback
 
+# unique per process and per call, so concurrent provisions cannot
+# collide on instance names
+_inst_counter = itertools.count()
+
+# resolve the lxc binary once to skip the $PATH search per invocation
+_LXC = shutil.which("lxc") or "lxc"
+
+# cache identity lookups once; getpwuid/getgrgid go through NSS and can
+# be slow (e.g., LDAP/SSSD), and provision may run once per charm
+_UID = os.getuid()
+_GID = os.getgid()
+_PW = pwd.getpwuid(_UID)
+_GR = grp.getgrgid(_GID)
+_IDMAP = f"raw.idmap=both {_UID} {_GID}"
+
 
 class LxcInstance:
     """Minimal support for provisioning and working with an Lxc
@@ -18,99 +35,161 @@ class LxcInstance:
         self.inst_name = inst_name
         self.capture = kwargs.get("capture", False)
 
-    def add_group(self, name, gid):
-        return self.exec("--", "groupadd", "-g", str(gid), name)
-
-    def add_user(self, homepath, name, uid, gid, shell):
-        self.exec(
-            "--",
-            "useradd",
-            "-d",
-            homepath,
-            "-g",
-            str(gid),
-            "-m",
-            "-s",
-            shell,
-            "-u",
-            str(uid),
-            name,
+    def add_user_group(self, homepath, username, groupname, uid, gid, shell):
+        """Add matching group and user entries with a single exec.
+
+        Returns a Popen so the caller can overlap it with other setup
+        steps."""
+
+        groupadd = f"groupadd -g {gid} {shlex.quote(groupname)}"
+        useradd = (
+            f"useradd -d {shlex.quote(homepath)} -g {gid} -m"
+            f" -s {shlex.quote(shell)} -u {uid} {shlex.quote(username)}"
         )
+        return self.exec_async("--", "sh", "-c", f"{groupadd} && {useradd}", quiet=True)
 
     def config(self, op, *args, **kwargs):
         capture = kwargs.get("capture", self.capture)
         return subprocess.run(
-            ["lxc", "config", op, self.inst_name, *args],
+            [_LXC, "config", op, self.inst_name, *args],
             capture_output=capture,
             text=True,
+            close_fds=False,
         )
 
     def config_device(self, op, *args, **kwargs):
         capture = kwargs.get("capture", self.capture)
         return subprocess.run(
-            ["lxc", "config", "device", op, self.inst_name, *args],
+            [_LXC, "config", "device", op, self.inst_name, *args],
             capture_output=capture,
             text=True,
+            close_fds=False,
         )
 
     def exec(self, *args, **kwargs):
         capture = kwargs.get("capture", self.capture)
+        quiet = kwargs.get("quiet", False)
         cp = subprocess.run(
-            ["lxc", "exec", self.inst_name, *args],
+            [_LXC, "exec", self.inst_name, *args],
             capture_output=capture,
+            stdout=subprocess.DEVNULL if quiet and not capture else None,
+            stderr=subprocess.DEVNULL if quiet and not capture else None,
             text=True,
+            close_fds=False,
         )
         return cp
 
+    def exec_async(self, *args, **kwargs):
+        """Start an exec without waiting for it. Returns the Popen."""
+
+        quiet = kwargs.get("quiet", False)
+        return subprocess.Popen(
+            [_LXC, "exec", self.inst_name, *args],
+            stdout=subprocess.DEVNULL if quiet else None,
+            stderr=subprocess.DEVNULL if quiet else None,
+            text=True,
+            close_fds=False,
+        )
+
     def file(self, op, *args, **kwargs):
         capture = kwargs.get("capture", self.capture)
         return subprocess.run(
-            ["lxc", "file", op, *args],
+            [_LXC, "file", op, *args],
             capture_output=capture,
             text=True,
+            close_fds=False,
         )
 
     def file_pull(self, src, dst, *args, **kwargs):
         capture = kwargs.get("capture", self.capture)
         return subprocess.run(
-            ["lxc", "file", "pull", f"{self.inst_name}/{src}", dst, *args],
+            [_LXC, "file", "pull", f"{self.inst_name}/{src}", dst, *args],
             capture_output=capture,
             text=True,
+            close_fds=False,
+        )
+
+    def file_pull_many(self, srcs, dst, **kwargs):
+        """Pull multiple files with a single invocation (one LXD API
+        handshake instead of one per file)."""
+
+        capture = kwargs.get("capture", self.capture)
+        return subprocess.run(
+            [_LXC, "file", "pull", *[f"{self.inst_name}/{src}" for src in srcs], dst],
+            capture_output=capture,
+            text=True,
+            close_fds=False,
         )
 
     def file_push(self, src, dst, *args, **kwargs):
         capture = kwargs.get("capture", self.capture)
         return subprocess.run(
-            ["lxc", "file", "push", src, f"{self.inst_name}/{dst}", *args],
+            [_LXC, "file", "push", src, f"{self.inst_name}/{dst}", *args],
             capture_output=capture,
             text=True,
+            close_fds=False,
         )
 
     def launch(self, image_name, *args, **kwargs):
         capture = kwargs.get("capture", self.capture)
         return subprocess.run(
-            ["lxc", "launch", image_name, self.inst_name, *args],
+            [_LXC, "launch", image_name, self.inst_name, *args],
             capture_output=capture,
             text=True,
+            close_fds=False,
         )
 
-    def listdir(self, path):
+    def list_charms(self, path):
+        """List `.charm` filenames directly under path, filtering in
+        the container rather than in Python."""
+
         cp = subprocess.run(
-            ["lxc", "exec", self.inst_name, "--", "ls", "-1", path], capture_output=True, text=True
+            [
+                _LXC,
+                "exec",
+                self.inst_name,
+                "--",
+                "find",
+                path,
+                "-maxdepth",
+                "1",
+                "-type",
+                "f",
+                "-name",
+                "*.charm",
+                "-printf",
+                "%f\\n",
+            ],
+            capture_output=True,
+            text=True,
+            close_fds=False,
         )
 
         if cp.returncode == 0:
-            return [s for s in cp.stdout.split("\n") if s != ""]
+            return cp.stdout.splitlines()
         else:
             return []
 
     def stop(self, **kwargs):
         capture = kwargs.get("capture", self.capture)
         force = kwargs.get("force", False)
-        cmdargs = ["lxc", "stop", self.inst_name]
+        cmdargs = [_LXC, "stop", self.inst_name]
         if force:
             cmdargs.append("-f")
-        return subprocess.run(cmdargs, capture_output=capture, text=True)
+        return subprocess.run(cmdargs, capture_output=capture, text=True, close_fds=False)
+
+
+def _find_mount(path):
+    """Find the mount point of a path by walking up until the device
+    (st_dev) changes. Avoids shelling out to `df`."""
+
+    path = os.path.abspath(path)
+    dev = os.stat(path).st_dev
+    while True:
+        parent = os.path.dirname(path)
+        if parent == path or os.stat(parent).st_dev != dev:
+            return path
+        path = parent
 
 
 def provision(based, charm_dir):
@@ -126,46 +205,30 @@ def provision(based, charm_dir):
         workdir = f"{overlay_base_dir}/work"
         mergedir = f"{overlay_base_dir}/merge"
 
-        # create directories
-        lxci.exec("--", "mkdir", "-p", upperdir, capture=False)
-        lxci.exec("--", "mkdir", "-p", workdir, capture=False)
-        lxci.exec("--", "mkdir", "-p", mergedir, capture=False)
-
-        # mount overlay
-        lxci.exec(
-            "--",
-            "mount",
-            "-t",
-            "overlay",
-            "overlay",
-            "-o",
-            f"lowerdir={src},upperdir={upperdir},workdir={workdir}",
-            mergedir,
-            capture=False,
+        # create directories, mount overlay, bind overlay — one exec
+        # instead of five round-trips through lxc/LXD
+        script = (
+            f"mkdir -p {upperdir} {workdir} {mergedir}"
+            f" && mount -t overlay overlay"
+            f" -o lowerdir={shlex.quote(src)},upperdir={upperdir},workdir={workdir}"
+            f" {mergedir}"
+            f" && mount --bind {mergedir} {shlex.quote(src)}"
         )
+        return lxci.exec_async("--", "sh", "-c", script, quiet=True)
 
-        # bind overlay
-        lxci.exec("--", "mount", "--bind", mergedir, src, capture=False)
+    lxci = None
 
     try:
         # get mount point of charm_dir
-        cp = subprocess.run(["df", "--output=target", charm_dir], capture_output=True, text=True)
-        if cp.returncode == 1:
-            return
+        mount_path = _find_mount(charm_dir)
 
-        lines = [s for s in cp.stdout.split("\n") if s != ""]
-        mount_path = lines[-1]
-
-        inst_id = int(time.time() * 100) % 10000000
-        inst_name = f"charms-builder-{inst_id}"
+        inst_name = f"charms-builder-{os.getpid()}-{next(_inst_counter)}"
         image_name = based.get("image")
 
         lxci = LxcInstance(inst_name)
 
         # launch ephermeral instance with image
-        cp = lxci.launch(
-            image_name, "-e", "-c", f"raw.idmap=both {os.getuid()} {os.getgid()}", capture=False
-        )
+        cp = lxci.launch(image_name, "-e", "-c", _IDMAP, capture=False)
 
         # pass through charm directory/filesystem
         lxci.config_device(
@@ -179,17 +242,18 @@ def provision(based, charm_dir):
         )
         # overlays
         # setup_overlay("etc", "/etc", "/etc")
-        setup_overlay("charmfs", mount_path, mount_path)
-
-        # add group and user
-        pw = pwd.getpwuid(os.getuid())
-        gr = grp.getgrgid(os.getgid())
+        setup_overlay("charmfs", mount_path, mount_path).wait()
 
-        lxci.add_group(gr.gr_name, pw.pw_gid)
-        lxci.add_user(pw.pw_dir, pw.pw_name, pw.pw_uid, pw.pw_gid, pw.pw_shell)
+        # add group and user; useradd -m writes the home directory,
+        # which may live under mount_path, so this must run only after
+        # the overlay has made mount_path writable
+        lxci.add_user_group(
+            _PW.pw_dir, _PW.pw_name, _GR.gr_name, _PW.pw_uid, _PW.pw_gid, _PW.pw_shell
+        ).wait()
 
         return lxci
-    except:
+    except Exception:
         # back out/clean up
         traceback.print_exc()
-        lxci.stop()
+        if lxci is not None:
+            lxci.stop()